@@ -12,21 +12,26 @@ Usage:
                                [--transpose N] [--clamp]
 """
 
-import mido
 import sys
 import os
 import argparse
 import re
+import math
+import struct
 import subprocess
 from dataclasses import dataclass
+from functools import lru_cache
+from bisect import bisect_left
+from operator import attrgetter, itemgetter
 from typing import List, Tuple, Optional, Callable, Iterable
 
 NOTE_MIN = 53
 NOTE_MAX = 79
-@dataclass
+@dataclass(slots=True)
 class MidiNote:
     """
     Compact event: no button mapping, no octave shift.
+    Slotted so long note lists don't carry a __dict__ per instance.
     """
     index: int = 0
     midiNoteNumber: int = 0
@@ -36,23 +41,35 @@ class MidiNote:
 
 # -------- Helpers --------
 
+FRAC_NAMES = ("1st", "1/2nd", "1/4th", "1/8th", "1/16th", "1/32nd", "1/64th")
+
+
+@lru_cache(maxsize=256)
 def duration_to_fraction(duration_ms: int, tempo: int = 500000) -> str:
     """
     Rough bucket for the shortest note comment.
+    Bucket k is a note of 4 / 2**k quarters; log2 picks the two neighbours.
     """
+    if tempo <= 0:
+        # Degenerate tempo: give the answer of the old nearest-in-ms scan.
+        if tempo == 0:
+            return FRAC_NAMES[0]  # every bucket is 0 ms; the first wins
+        if duration_ms >= 0:
+            return FRAC_NAMES[-1]
+        return duration_to_fraction(-duration_ms, -tempo)  # mirrored distances
+    if duration_ms <= 0:
+        return FRAC_NAMES[-1]
     quarter_note_ms = tempo / 1000
-    fractions = [
-        (4.0, "1st"), (2.0, "1/2nd"), (1.0, "1/4th"),
-        (0.5, "1/8th"), (0.25, "1/16th"), (0.125, "1/32nd"), (0.0625, "1/64th")
-    ]
-    best = "1/16th"
-    mdiff = float("inf")
-    for mult, name in fractions:
-        diff = abs(duration_ms - quarter_note_ms * mult)
-        if diff < mdiff:
-            mdiff = diff
-            best = name
-    return best
+    k = math.floor(math.log2(4 * quarter_note_ms / duration_ms))
+    if k < 0:
+        return FRAC_NAMES[0]
+    if k >= len(FRAC_NAMES) - 1:
+        return FRAC_NAMES[-1]
+    # duration lies between buckets k and k+1; keep the nearer (ties -> k).
+    longer = quarter_note_ms * 4 / (1 << k)
+    if longer - duration_ms > duration_ms - longer / 2:
+        k += 1
+    return FRAC_NAMES[k]
 
 
 def format_midi_notes_as_c_array(midi_notes: List[MidiNote], song_name: str) -> str:
@@ -60,30 +77,30 @@ def format_midi_notes_as_c_array(midi_notes: List[MidiNote], song_name: str) ->
     Emit a C++ namespace with a const array of MidiNote.
     Fields: index, midiNoteNumber, timeMSec, noteDuration
     """
-    lines = [
+    body = ",\n".join(
+        "    {%d, %d, %d, %d}" % (n.index, n.midiNoteNumber, n.timeMSec, n.noteDuration)
+        for n in midi_notes
+    )
+
+    parts = [
         '#include "MidiSong.h"',
         '',
         'namespace songs {',
-        '  const MidiNote SONG[] = {'
+        '  const MidiNote SONG[] = {',
     ]
-
-    for i, n in enumerate(midi_notes):
-        line = f"    {{{n.index}, {n.midiNoteNumber}, {n.timeMSec}, {n.noteDuration}}}"
-        if i < len(midi_notes) - 1:
-            line += ","
-        lines.append(line)
-
-    lines.append('  };')
-    lines.append('')
-    lines.append(f'  REGISTER_SONG({song_name}, SONG)')
+    if body:
+        parts.append(body)
+    parts.append('  };')
+    parts.append('')
+    parts.append(f'  REGISTER_SONG({song_name}, SONG)')
 
     if midi_notes:
-        shortest = min(n.noteDuration for n in midi_notes)
-        lines.append(f'}} // {duration_to_fraction(shortest)}')
+        shortest = min(map(attrgetter('noteDuration'), midi_notes))
+        parts.append(f'}} // {duration_to_fraction(shortest)}')
     else:
-        lines.append('}')
+        parts.append('}')
 
-    return "\n".join(lines)
+    return "\n".join(parts)
 
 
 # -------- Transform pipeline --------
@@ -93,6 +110,8 @@ class TransformOptions:
     time_shift_ms: int = 0
     time_scale: float = 1.0
     min_duration_ms: int = 0
+    transpose: int = 0      # semitones, result kept within 0..127
+    clamp: bool = False     # clamp notes to [NOTE_MIN, NOTE_MAX]
 
 Modifier = Callable[[MidiNote], MidiNote]
 
@@ -100,63 +119,288 @@ Modifier = Callable[[MidiNote], MidiNote]
 def apply_transforms(notes: Iterable[MidiNote],
                      opts: TransformOptions,
                      extra_modifiers: Iterable[Modifier] = ()) -> List[MidiNote]:
+    scale = opts.time_scale
+    shift = opts.time_shift_ms
+    min_dur = opts.min_duration_ms
+    transpose = opts.transpose
+    clamp = opts.clamp
+    mods = tuple(extra_modifiers)
+
+    # Built-in transforms run fused in one pass; extra modifiers see the result.
     out: List[MidiNote] = []
+    append = out.append
     for n in notes:
-        m = MidiNote(**vars(n))  # copy
+        t = n.timeMSec
+        d = n.noteDuration
+        p = n.midiNoteNumber
+
+        if scale != 1.0:
+            t = int(round(t * scale))
+            d = int(round(d * scale))
+
+        if shift:
+            t += shift
 
-        if opts.time_scale != 1.0:
-            m.timeMSec = int(round(m.timeMSec * opts.time_scale))
-            m.noteDuration = int(round(m.noteDuration * opts.time_scale))
+        if min_dur and d < min_dur:
+            d = min_dur
 
-        if opts.time_shift_ms:
-            m.timeMSec += opts.time_shift_ms
+        if transpose:
+            p = max(0, min(127, p + transpose))
 
-        if opts.min_duration_ms and m.noteDuration < opts.min_duration_ms:
-            m.noteDuration = opts.min_duration_ms
+        if clamp:
+            p = max(NOTE_MIN, min(NOTE_MAX, p))
 
-        for mod in extra_modifiers:
+        m = MidiNote(n.index, p, t, d)  # copy
+        for mod in mods:
             m = mod(m)
 
-        out.append(m)
+        append(m)
 
-    if out:
+    # Input from convert_to_midi_notes already starts at 0; only the time
+    # transforms (or arbitrary modifiers) can move the earliest note.
+    if out and (shift or scale != 1.0 or mods):
         t0 = min(e.timeMSec for e in out)
-        for e in out:
-            e.timeMSec -= t0
+        if t0:
+            for e in out:
+                e.timeMSec -= t0
 
     return out
 
 
 # -------- MIDI parsing --------
 
-def transcribe_midi(midi_file_path: str) -> List[Tuple[int, int, str]]:
+# Data bytes after a channel status byte, keyed by its high nibble.
+_CHANNEL_DATA_LEN = {0x8: 2, 0x9: 2, 0xA: 2, 0xB: 2, 0xC: 1, 0xD: 1, 0xE: 2}
+# Data bytes after system common/realtime status bytes (default 0).
+_SYSTEM_DATA_LEN = {0xF1: 1, 0xF2: 2, 0xF3: 1}
+
+
+def _read_varlen(data: bytes, pos: int) -> Tuple[int, int]:
+    """
+    Decode a variable-length quantity; return (value, next_pos).
+    """
+    value = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value = (value << 7) | (b & 0x7F)
+        if b < 0x80:
+            return value, pos
+
+
+def _read_midi_chunks(data: bytes) -> Tuple[int, List[Tuple[int, int]]]:
+    """
+    Parse the SMF header; return (ticks_per_beat, [(start, end), ...]) for
+    each MTrk chunk. Unknown chunk types are skipped.
+    """
+    if data[:4] != b'MThd':
+        raise ValueError('MThd not found. Probably not a MIDI file')
+    (header_len,) = struct.unpack_from('>I', data, 4)
+    _fmt, _ntracks, division = struct.unpack_from('>HHh', data, 8)
+    if division <= 0:
+        raise ValueError('SMPTE time division is not supported')
+
+    tracks: List[Tuple[int, int]] = []
+    pos = 8 + header_len
+    while pos + 8 <= len(data):
+        name = data[pos:pos + 4]
+        (size,) = struct.unpack_from('>I', data, pos + 4)
+        pos += 8
+        if name == b'MTrk':
+            tracks.append((pos, min(pos + size, len(data))))
+        pos += size
+    return division, tracks
+
+
+def _read_track(data: bytes, pos: int, end: int, max_on: Optional[int] = None
+                ) -> Tuple[List[int], List[int], List[str], List[Tuple[int, int]],
+                           Optional[int]]:
+    """
+    Scan one MTrk chunk without building message objects.
+    Returns (ticks, notes, states, tempo_changes, stop_tick) where the first
+    three are parallel per note event (absolute tick, note number, "ON"/"OFF")
+    and tempo_changes holds (tick, tempo) for each set_tempo.
+    With max_on, reading stops at the next ON after that many; stop_tick is
+    its tick (events at or after it may be missing), else None.
+    """
+    ticks: List[int] = []
+    notes: List[int] = []
+    states: List[str] = []
+    tempo_changes: List[Tuple[int, int]] = []
+    tick = 0
+    status = 0
+    on_left = max_on if max_on is not None else -1
+    stop_tick: Optional[int] = None
+
+    while pos < end:
+        b = data[pos]
+        pos += 1
+        delta = b & 0x7F
+        while b & 0x80:
+            b = data[pos]
+            pos += 1
+            delta = (delta << 7) | (b & 0x7F)
+        tick += delta
+
+        b = data[pos]
+        if b & 0x80:
+            pos += 1
+            if b < 0xF0:
+                status = b  # meta/sysex don't set running status
+        elif status:
+            b = status  # running status: b was the first data byte
+        else:
+            raise ValueError('running status without a previous status byte')
+
+        if b == 0xFF:
+            meta_type = data[pos]
+            length, pos = _read_varlen(data, pos + 1)
+            if meta_type == 0x51 and length == 3:
+                tempo = (data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2]
+                tempo_changes.append((tick, tempo))
+            pos += length
+        elif b == 0xF0 or b == 0xF7:
+            length, pos = _read_varlen(data, pos)
+            pos += length
+        elif b > 0xF0:
+            pos += _SYSTEM_DATA_LEN.get(b, 0)
+        else:
+            kind = b >> 4
+            n_data = _CHANNEL_DATA_LEN[kind]
+            if data[pos] & 0x80 or (n_data == 2 and data[pos + 1] & 0x80):
+                raise ValueError('data byte must be in range 0..127')
+            if kind == 0x9 or kind == 0x8:
+                if kind == 0x9 and data[pos + 1]:
+                    if on_left == 0:
+                        stop_tick = tick
+                        break
+                    on_left -= 1
+                    state = "ON"
+                else:
+                    state = "OFF"
+                ticks.append(tick)
+                notes.append(data[pos])
+                states.append(state)
+                pos += 2
+            else:
+                pos += n_data
+
+    return ticks, notes, states, tempo_changes, stop_tick
+
+
+def _build_tempo_map(changes: List[Tuple[int, int]],
+                     default_tempo: int) -> List[Tuple[int, int, int]]:
+    """
+    Turn (tick, tempo) changes from any track into segments
+    (start_tick, tempo, base), where base is the sum of tempo * ticks
+    before start_tick. A later change at the same tick wins.
+    """
+    tempo_map = [(0, default_tempo, 0)]
+    for tick, tempo in sorted(changes, key=itemgetter(0)):
+        start, cur, base = tempo_map[-1]
+        if tick == start:
+            tempo_map[-1] = (start, tempo, base)
+        else:
+            tempo_map.append((tick, tempo, base + (tick - start) * cur))
+    return tempo_map
+
+
+def _ticks_to_ms(ticks: List[int], tempo_map: List[Tuple[int, int, int]],
+                 denom: int) -> List[int]:
+    """
+    Convert sorted absolute ticks to ms through the tempo map:
+    (base + (tick - start) * tempo) // denom within each segment.
+    The terms are reduced by their gcd once per segment so each event
+    multiplies small ints.
+    """
+    out: List[int] = []
+    lo = 0
+    n_ticks = len(ticks)
+    for i, (start, tempo, base) in enumerate(tempo_map):
+        if i + 1 < len(tempo_map):
+            hi = bisect_left(ticks, tempo_map[i + 1][0], lo)
+        else:
+            hi = n_ticks
+        if hi > lo:
+            off = base - start * tempo
+            g = math.gcd(tempo, denom, off)
+            num, den, off = tempo // g, denom // g, off // g
+            if den == 1:
+                out.extend([off + t * num for t in ticks[lo:hi]])
+            else:
+                out.extend([(off + t * num) // den for t in ticks[lo:hi]])
+        lo = hi
+    return out
+
+
+def _count_note_pairs(events: List[Tuple[int, int, str]]) -> int:
+    """
+    Number of notes convert_to_midi_notes would pair from events (no limit).
+    """
+    # Pairing rule must stay in sync with convert_to_midi_notes.
+    sounding = [False] * 128
+    pairs = 0
+    for note_num, _, state in events:
+        if state == "ON":
+            sounding[note_num] = True
+        elif sounding[note_num]:
+            sounding[note_num] = False
+            pairs += 1
+    return pairs
+
+
+def _transcribe_events(data: bytes, max_on: Optional[int] = None
+                       ) -> Tuple[List[Tuple[int, int, str]], Optional[int]]:
+    """
+    Build the sorted event list; with max_on, each track is read only up to
+    that many ON events. Returns (events, pairs), where pairs is the number
+    of notes a cut-short read yields, or None if every track was read fully.
+    """
+    ticks_per_beat, track_chunks = _read_midi_chunks(data)
+    default_tempo = 500000  # 120 BPM
+    denom = ticks_per_beat * 1000
+
+    tracks = [_read_track(data, start, end, max_on) for start, end in track_chunks]
+
+    # Tempo is global: changes (normally all in track 0) apply to every track.
+    tempo_map = _build_tempo_map([c for t in tracks for c in t[3]], default_tempo)
+
+    note_events: List[Tuple[int, int, str]] = []
+    for ticks, notes, states, _, _ in tracks:
+        note_events.extend(zip(notes, _ticks_to_ms(ticks, tempo_map, denom), states))
+
+    # One stream across all tracks. Stable; each track is already a sorted
+    # run, which timsort merges cheaply.
+    note_events.sort(key=itemgetter(1))
+
+    # A cut-short track is only complete below its stop tick. Time never
+    # decreases with ticks, so everything before that tick's ms is exact.
+    stops = [t[4] for t in tracks if t[4] is not None]
+    if not stops:
+        return note_events, None
+    cutoff_ms = _ticks_to_ms([min(stops)], tempo_map, denom)[0]
+    del note_events[bisect_left(note_events, cutoff_ms, key=itemgetter(1)):]
+    return note_events, _count_note_pairs(note_events)
+
+
+def transcribe_midi(midi_file_path: str,
+                    limit: Optional[int] = None) -> List[Tuple[int, int, str]]:
     """
     Return events as (midi_note_number, timestamp_ms, "ON"/"OFF").
+    With limit, tracks are read only far enough to yield that many notes.
     """
     try:
-        mid = mido.MidiFile(midi_file_path)
-        note_events: List[Tuple[int, int, str]] = []
-
-        ticks_per_beat = mid.ticks_per_beat
-        default_tempo = 500000  # 120 BPM
-
-        # Parse first two tracks; adjust if needed.
-        for track in mid.tracks[:2]:
-            cur_ticks = 0
-            tempo = default_tempo
-            for msg in track:
-                cur_ticks += msg.time
-                time_ms = int((cur_ticks * tempo) / (ticks_per_beat * 1000))
-
-                if msg.type == 'set_tempo':
-                    tempo = msg.tempo
-                elif msg.type == 'note_on' and msg.velocity > 0:
-                    note_events.append((msg.note, time_ms, "ON"))
-                elif msg.type == 'note_off' or (msg.type == 'note_on' and msg.velocity == 0):
-                    note_events.append((msg.note, time_ms, "OFF"))
-
-        note_events.sort(key=lambda x: x[1])
-        return note_events
+        with open(midi_file_path, 'rb') as f:
+            data = f.read()
+
+        if limit is not None:
+            events, pairs = _transcribe_events(data, max(256, 4 * limit))
+            # convert_to_midi_notes yields at least one note even for limit <= 0.
+            if pairs is None or pairs >= max(limit, 1):
+                return events
+
+        events, _ = _transcribe_events(data)
+        return events
     except Exception as e:
         print(f"Error processing MIDI file: {e}")
         return []
@@ -168,21 +412,25 @@ def convert_to_midi_notes(events: List[Tuple[int, int, str]],
     Pair ON/OFF into MidiNote structs with raw MIDI note numbers.
     """
     out: List[MidiNote] = []
-    active = {}  # note -> start_time_ms
+    append = out.append
+    active = [-1] * 128  # note -> start_time_ms, -1 when not sounding
     idx = 0
+    # Every note consumes an OFF event, so len(events) is never reached.
+    max_notes = limit if limit is not None else len(events)
 
+    # Pairing rule must stay in sync with _count_note_pairs.
     for note_num, t_ms, state in events:
         if state == "ON":
             active[note_num] = t_ms
-        elif state == "OFF" and note_num in active:
-            start = active.pop(note_num)
-            out.append(MidiNote(index=idx,
-                                midiNoteNumber=note_num,
-                                timeMSec=start,
-                                noteDuration=t_ms - start))
-            idx += 1
-            if limit is not None and len(out) >= limit:
-                break
+            continue
+        start = active[note_num]
+        if start < 0:
+            continue
+        active[note_num] = -1
+        append(MidiNote(idx, note_num, start, t_ms - start))
+        idx += 1
+        if idx >= max_notes:
+            break
 
     if out:
         t0 = min(n.timeMSec for n in out)
@@ -192,9 +440,13 @@ def convert_to_midi_notes(events: List[Tuple[int, int, str]],
     return out
 
 
+_SANITIZE_RE = re.compile(r'[^A-Za-z0-9]+')
+
+
+@lru_cache(maxsize=256)
 def filename_to_song_name(midi_file_path: str) -> str:
     base = os.path.splitext(os.path.basename(midi_file_path))[0]
-    words = [w for w in re.split(r'[^A-Za-z0-9]+', base) if w]
+    words = [w for w in _SANITIZE_RE.split(base) if w]
     return "".join(w[:1].upper() + w[1:] for w in words) or "Song"
 
 
@@ -231,7 +483,7 @@ def main():
 
     print(f"Transcribing MIDI file: {midi_file_path}")
 
-    events = transcribe_midi(midi_file_path)
+    events = transcribe_midi(midi_file_path, args.limit)
     if not events:
         print("No note events found or error occurred.")
         return
@@ -242,38 +494,27 @@ def main():
         time_shift_ms=args.time_shift_ms,
         time_scale=args.time_scale,
         min_duration_ms=args.min_duration_ms,
+        transpose=args.transpose,
+        clamp=args.clamp,
     )
 
-    extra_mods: List[Modifier] = []
-
-    if args.transpose != 0:
-        def make_transposer(semitones: int) -> Modifier:
-            def _mod(n: MidiNote) -> MidiNote:
-                # clamp to valid MIDI
-                n.midiNoteNumber = max(0, min(127, n.midiNoteNumber + semitones))
-                return n
-            return _mod
-
-        extra_mods.append(make_transposer(args.transpose))
-
-    if args.clamp:
-        def _clamp(n: MidiNote) -> MidiNote:
-            n.midiNoteNumber = max(NOTE_MIN, min(NOTE_MAX, n.midiNoteNumber))
-            return n
-        extra_mods.append(_clamp)
-
-    notes = apply_transforms(notes, topts, extra_mods)
+    notes = apply_transforms(notes, topts)
 
     song_name = filename_to_song_name(midi_file_path)
     out_txt = format_midi_notes_as_c_array(notes, song_name)
     print(out_txt)
 
     output_filename = os.path.splitext(midi_file_path)[0] + "_transcription.txt"
-    with open(output_filename, 'w') as f:
-        f.write(out_txt)
+    out_bytes = out_txt.encode('utf-8')  # encoded once for file and clipboard
+    with open(output_filename, 'wb') as f:
+        f.write(out_bytes)
     print(f"\nTranscription saved to: {output_filename}")
+
+    # pbcopy only exists on macOS; MIDI_NO_CLIPBOARD=1 skips it there too.
+    if sys.platform != 'darwin' or os.environ.get('MIDI_NO_CLIPBOARD') == '1':
+        return
     try:
-        subprocess.run(["pbcopy"], input=out_txt, text=True, check=True)
+        subprocess.run(["pbcopy"], input=out_bytes, check=True)
         print("Transcription copied to clipboard.")
     except Exception as e:
         print(f"Warning: failed to copy to clipboard: {e}")